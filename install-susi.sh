@@ -491,7 +491,7 @@ fi
 
 echo "Setting up Python modules"
 mkdir -p "$PYTHONMODDIR"
-for i in hwmixer susi_config vlcplayer ; do
+for i in hwmixer playerd susi_config vlcplayer ; do
     ln -s ../susi_installer/pythonmods/$i "$PYTHONMODDIR/$i"
 done
 ln -s ../susi_python/susi_python "$PYTHONMODDIR/susi_python"
@@ -1,42 +1,204 @@
 """ HW Mixer module """
 
-import alsaaudio
+import os
+import json
+import select
+import logging
+import tempfile
+import threading
+
+from susi_config import cache_path
+
+logger = logging.getLogger(__name__)
+
+# defaults of audio.cards and audio.mixers in the SUSI.AI configuration
+default_cards = 'seeed'
+default_mixers = 'Master,PCM,Speaker,Playback'
+
+def configured_preferences():
+    try:
+        from susi_config import SusiConfig
+        cfg = SusiConfig()
+        return cfg.get('audio.cards'), cfg.get('audio.mixers')
+    except Exception as e:
+        logger.warning("hwmixer: cannot read audio configuration: %s", e)
+        return default_cards, default_mixers
+
+def split_list(val):
+    return [ v.strip() for v in val.split(',') if v.strip() ]
+
+def playback_controls(alsaaudio, ci):
+    # controls like 'Capture' cannot change the output volume
+    controls = []
+    for control in alsaaudio.mixers(ci):
+        try:
+            caps = alsaaudio.Mixer(cardindex=ci, control=control).volumecap()
+        except alsaaudio.ALSAAudioError:
+            continue
+        if 'Volume' in caps or 'Playback Volume' in caps:
+            controls.append(control)
+    return controls
+
+def discover(alsaaudio, cards, mixers):
+    # Returns [ [ cardindex, control ], ... ] of the cards to drive: all
+    # cards whose name contains one of the comma separated cards patterns
+    # ('*' for all cards), the control being the first of mixers the card
+    # has, otherwise its first playback control. With the default mixers the
+    # control is chosen as it always was: the last one of them in the order
+    # of the card, e.g. Playback and not Speaker on wm8960 HATs. If no card
+    # matches, the first card with its first playback control is used, like
+    # before cards could be configured.
+    patterns = [ p.lower() for p in split_list(cards) ]
+    indexes = list(alsaaudio.card_indexes())
+    names = alsaaudio.cards()
+    selected = [ ci for ci, name in zip(indexes, names)
+                 if any(p == '*' or p in name.lower() for p in patterns) ]
+    preferences = split_list(mixers)
+    if not selected:
+        selected = indexes[:1]
+        preferences = []
+    found = []
+    for ci in selected:
+        controls = playback_controls(alsaaudio, ci)
+        if mixers == default_mixers:
+            preferred = [ m for m in controls if m in preferences ][-1:]
+        else:
+            preferred = [ m for m in preferences if m in controls ]
+        if preferred:
+            found.append([ci, preferred[0]])
+        elif controls:
+            found.append([ci, controls[0]])
+        else:
+            logger.warning("hwmixer: card %d has no mixer", ci)
+    if not found:
+        raise Exception('Cannot find mixer')
+    return found
+
+def cached_discovery(alsaaudio, cards, mixers, rediscover = False):
+    # mixers are only enumerated again if the cards or the preferences
+    # changed since the last start, or if rediscover is given
+    cachefile = os.path.join(cache_path, 'hwmixer.json')
+    key = [ list(zip(alsaaudio.card_indexes(), alsaaudio.cards())), cards, mixers ]
+    key = json.loads(json.dumps(key))
+    try:
+        if rediscover:
+            os.remove(cachefile)
+        else:
+            with open(cachefile) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                return cached['mixers']
+    except (OSError, ValueError, KeyError):
+        pass
+    found = discover(alsaaudio, cards, mixers)
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_path, prefix='.hwmixer')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': key, 'mixers': found}, f)
+        os.replace(tmp, cachefile)
+    except OSError as e:
+        logger.warning("hwmixer: cannot store mixer discovery: %s", e)
+    return found
 
 class HwMixer():
 
     saved_volume = -1
 
-    def __init__(self):
-        self.mixerid = ''
-        self.cardindex = None
-        for ci in alsaaudio.card_indexes():
-            if "seeed" in alsaaudio.cards()[ci]:
-                self.cardindex = ci
-        if self.cardindex is None:
-            # We don't run a seeed card, use the default mixer
-            self.cardindex = 0
-            self.mixerid = alsaaudio.mixers(self.cardindex)[0]
-        else:
-            for i in alsaaudio.mixers(self.cardindex):
-                if i == 'Master' or i == 'PCM' or i == 'Speaker' or i == 'Playback':
-                    self.mixerid = i
-            if self.mixerid == '':
-                raise Exception('Cannot find mixer')
-        self.mixer = alsaaudio.Mixer(cardindex=self.cardindex, control=self.mixerid)
+    # cards and mixers are comma separated lists, see discover(); they
+    # default to audio.cards and audio.mixers of the SUSI.AI configuration
+    def __init__(self, cards = None, mixers = None):
+        # imported here so that importing the module does not touch ALSA
+        import alsaaudio
+        if cards is None or mixers is None:
+            cfg_cards, cfg_mixers = configured_preferences()
+            cards = cfg_cards if cards is None else cards
+            mixers = cfg_mixers if mixers is None else mixers
+        found = cached_discovery(alsaaudio, cards, mixers)
+        # all selected cards are set to the same volume, the first one is
+        # the one the volume is read from
+        try:
+            self.mixers = [ alsaaudio.Mixer(cardindex=ci, control=control) for ci, control in found ]
+        except alsaaudio.ALSAAudioError as e:
+            logger.warning("hwmixer: stored mixer not available, discovering again: %s", e)
+            found = cached_discovery(alsaaudio, cards, mixers, True)
+            self.mixers = [ alsaaudio.Mixer(cardindex=ci, control=control) for ci, control in found ]
+        self.cardindex, self.mixerid = found[0]
+        self.mixer = self.mixers[0]
+        # The hardware volume is cached and kept up to date by a thread
+        # watching the poll descriptors of the mixer, so that reads do not
+        # go to ALSA and changes by other programs are noticed right away.
+        # Older pyalsaaudio has no handleevents(), then every read asks ALSA.
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.cached = None
+        if hasattr(self.mixer, 'handleevents'):
+            self.cached = self._read()
+            threading.Thread(target=self._watch, name='hwmixer', daemon=True).start()
 
-    def svol(self):
-        vols = self.mixer.getvolume()
+    def _read(self):
+        with self.lock:
+            vols = self.mixer.getvolume()
         return int(sum(vols)/len(vols))
 
+    def _update(self, vol):
+        if vol == self.cached:
+            return
+        self.cached = vol
+        for cb in list(self.listeners):
+            try:
+                cb(vol)
+            except Exception as e:
+                logger.error("hwmixer: volume listener failed: %s", e)
+
+    def _watch(self):
+        try:
+            poll = select.poll()
+            for m in self.mixers:
+                for fd, mask in m.polldescriptors():
+                    poll.register(fd, mask)
+            while True:
+                poll.poll()
+                with self.lock:
+                    # clears the pending events and refreshes the values
+                    for m in self.mixers:
+                        m.handleevents()
+                self._update(self._read())
+        except Exception as e:
+            # without events the cache would go stale, read from ALSA again
+            logger.error("hwmixer: watching the mixer failed: %s", e)
+            self.cached = None
+
+    # callback(volume) is called when the hardware volume changed, also
+    # by other programs like alsamixer
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def svol(self):
+        if self.cached is not None:
+            return self.cached
+        return self._read()
+
+    def _set(self, vol):
+        with self.lock:
+            for m in self.mixers:
+                m.setvolume(vol)
+        if self.cached is not None:
+            self._update(vol)
+
     def volume(self, val):
         if (val is None):
             return self.svol()
         elif (val == 'up'):
-            self.mixer.setvolume(min(100, self.svol() + 10))
+            self._set(min(100, self.svol() + 10))
         elif (val == 'dn'):
-            self.mixer.setvolume(max(0, self.svol() - 10))
+            self._set(max(0, self.svol() - 10))
         elif ((isinstance(val, int) or val.isdigit()) and (int(val) <= 100) and (int(val) >= 0)):
-            self.mixer.setvolume(int(val))
+            self._set(int(val))
         else:
             raise Exception('Unknown volume control')
 
@@ -45,6 +207,15 @@ class HwMixer():
 
     def restore_volume(self):
         if (self.saved_volume > 0):
-            self.mixer.setvolume(self.saved_volume)
+            self._set(self.saved_volume)
+
+mixer_lock = threading.Lock()
 
-mixer = HwMixer()
+def __getattr__(name):
+    # the mixer singleton is created on first access of hwmixer.mixer
+    if name != 'mixer':
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    with mixer_lock:
+        if 'mixer' not in globals():
+            globals()['mixer'] = HwMixer()
+    return globals()['mixer']
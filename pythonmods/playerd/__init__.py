@@ -0,0 +1,382 @@
+""" Player daemon module
+
+The player daemon owns the one VlcPlayer (and with it the HwMixer) of
+the system and executes commands sent by clients over a Unix socket.
+Each request and each answer is one line of JSON:
+  { "cmd": "volume", "args": [ "up" ] }
+  { "result": ... }  or  { "error": "..." }
+A { "cmd": "batch", "args": [ [ { "cmd": ..., "args": [...] }, ... ] ] }
+request executes several commands without other commands in between.
+After a { "cmd": "subscribe" } request the connection only carries
+player events:
+  { "event": "state", "data": { "state": "Playing" } }
+{ "cmd": "stats" } returns the queue depth and command latencies of
+the PlayerActor.
+"""
+
+import os
+import json
+import time
+import queue
+import socket
+import socketserver
+import threading
+import functools
+import collections
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# methods of VlcPlayer that can be called remotely
+commands = [
+    'play', 'playytb', 'playytbLink', 'playscloud', 'playtunein',
+    'prefetchytb', 'prefetchytbLink',
+    'next', 'previous', 'restart', 'shuffle', 'pause', 'resume', 'stop',
+    'is_playing', 'status', 'play_stats', 'preload', 'beep', 'say', 'volume',
+    'save_softvolume', 'restore_softvolume', 'save_hardvolume', 'restore_hardvolume'
+]
+
+# these commands block until the sound has been played, the actor only
+# starts them and the caller waits for the returned Future
+unlocked_commands = [ 'say' ]
+
+# looking up the stream of these commands can take seconds, the PlayerActor
+# does that with VlcPlayer.resolve() in the caller's thread and only the
+# start of playback with play_resolved() in its own thread
+play_commands = [ 'play', 'playytb', 'playytbLink', 'playscloud', 'playtunein' ]
+
+
+def check_batch(ops):
+    if not isinstance(ops, list):
+        raise ValueError('batch is not a list of operations')
+    for op in ops:
+        if not isinstance(op, dict) or op.get('cmd') not in commands \
+           or not isinstance(op.get('args', []), list):
+            raise ValueError('invalid operation in batch', op)
+
+def run_batch(player, ops):
+    # after the first failing operation the remaining ones are skipped
+    check_batch(ops)
+    results = []
+    failed = False
+    for op in ops:
+        res = {'cmd': op['cmd']}
+        if failed:
+            res['skipped'] = True
+        else:
+            start = time.monotonic()
+            try:
+                if op['cmd'] in play_commands and 'mrl' in op:
+                    res['result'] = player.play_resolved(op['mrl'])
+                else:
+                    res['result'] = getattr(player, op['cmd'])(*op.get('args', []))
+            except Exception as e:
+                res['error'] = str(e)
+                failed = True
+            res['duration'] = round(time.monotonic() - start, 4)
+        results.append(res)
+    return results
+
+
+class PlayerActor():
+
+    # All commands to the player are executed one after another by a single
+    # thread, callers get a Future. Play commands look up their stream in
+    # the caller's thread before they are queued, so the queue only holds
+    # short commands. Commands still waiting in the queue are
+    # coalesced:
+    # - consecutive volume commands become one absolute volume set
+    # - a play command drops all play commands queued before it
+    # - of consecutive pause/resume commands only the last one is kept
+    def __init__(self, player, maxsize = 32):
+        self.player = player
+        self.maxsize = maxsize
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.stats_lock = threading.Lock()
+        # cmd -> [count, total seconds, max seconds]
+        self.latency = {}
+        self.coalesced = 0
+        threading.Thread(target=self._run, name='player-actor', daemon=True).start()
+
+    @staticmethod
+    def _volume_step(val):
+        return val in ('up', 'dn') or (isinstance(val, int) and not isinstance(val, bool)) \
+            or (isinstance(val, str) and val.isdigit())
+
+    def _coalesce(self, cmd, args, f):
+        # called with self.cond held, returns True if f was attached to an
+        # already queued command
+        last = self.pending[-1] if self.pending else None
+        if cmd == 'volume' and len(args) == 1 and self._volume_step(args[0]):
+            if last is not None and last['cmd'] == 'volume' and 'steps' in last:
+                last['steps'].append(args[0])
+                last['futures'].append(f)
+                return True
+            return False
+        if cmd in play_commands:
+            for item in [i for i in self.pending if i['cmd'] in play_commands]:
+                self.pending.remove(item)
+                self.coalesced += 1
+                for old in item['futures']:
+                    old.set_result(None)
+        elif cmd in ('pause', 'resume') and last is not None and last['cmd'] in ('pause', 'resume'):
+            last['cmd'] = cmd
+            last['futures'].append(f)
+            return True
+        return False
+
+    def submit(self, cmd, *args):
+        f = Future()
+        item = {'cmd': cmd, 'args': args, 'futures': [f]}
+        if cmd in play_commands:
+            item['mrl'] = self.player.resolve(cmd, *args)
+            if item['mrl'] is None:
+                # nothing to play, the current playback goes on
+                f.set_result(False)
+                return f
+        with self.cond:
+            if self._coalesce(cmd, args, f):
+                self.coalesced += 1
+                return f
+            if len(self.pending) >= self.maxsize:
+                raise Exception('player command queue is full')
+            item['queued'] = time.monotonic()
+            if cmd == 'volume' and len(args) == 1 and self._volume_step(args[0]):
+                item['steps'] = [args[0]]
+            self.pending.append(item)
+            self.cond.notify()
+        return f
+
+    def call(self, cmd, *args):
+        return self.submit(cmd, *args).result()
+
+    def batch(self, ops):
+        check_batch(ops)
+        ops = [dict(op, mrl=self.player.resolve(op['cmd'], *op.get('args', [])))
+               if op['cmd'] in play_commands else op for op in ops]
+        return self.call('batch', ops)
+
+    def _volume(self, steps):
+        if len(steps) == 1:
+            return self.player.volume(steps[0])
+        vol = None
+        for val in steps:
+            if val == 'up' or val == 'dn':
+                if vol is None:
+                    vol = self.player.volume(None)
+                vol = min(100, vol + 10) if val == 'up' else max(0, vol - 10)
+            else:
+                vol = int(val)
+        return self.player.volume(vol)
+
+    def _execute(self, item):
+        cmd = item['cmd']
+        if cmd == 'batch':
+            return run_batch(self.player, *item['args'])
+        if 'steps' in item:
+            return self._volume(item['steps'])
+        if 'mrl' in item:
+            return self.player.play_resolved(item['mrl'])
+        if cmd == 'say':
+            # only start the sound, waiting happens in the caller's thread
+            mrl = item['args'][0]
+            wait_restore = item['args'][1] if len(item['args']) > 1 else True
+            f = self.player.say_async(mrl, wait_restore)
+            return f if wait_restore else None
+        return getattr(self.player, cmd)(*item['args'])
+
+    def _record(self, cmd, duration):
+        with self.stats_lock:
+            s = self.latency.setdefault(cmd, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += duration
+            s[2] = max(s[2], duration)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                item = self.pending.popleft()
+            try:
+                result = self._execute(item)
+            except Exception as e:
+                logger.error("playerd: command %s failed: %s", item['cmd'], e)
+                for f in item['futures']:
+                    f.set_exception(e)
+            else:
+                if isinstance(result, Future) and item['cmd'] in unlocked_commands:
+                    for f in item['futures']:
+                        result.add_done_callback(lambda r, f=f: f.set_result(None))
+                else:
+                    for f in item['futures']:
+                        f.set_result(result)
+            # latency as seen by the caller, including the time in the queue
+            self._record(item['cmd'], time.monotonic() - item['queued'])
+
+    def stats(self):
+        with self.cond:
+            depth = len(self.pending)
+        with self.stats_lock:
+            latency = { cmd: { 'count': s[0], 'avg': round(s[1] / s[0], 4), 'max': round(s[2], 4) }
+                        for cmd, s in self.latency.items() }
+        return { 'depth': depth, 'maxsize': self.maxsize, 'coalesced': self.coalesced, 'commands': latency }
+
+
+class PlayerRequestHandler(socketserver.StreamRequestHandler):
+
+    def stream_events(self):
+        events = queue.Queue(maxsize=100)
+        def listener(kind, data):
+            try:
+                events.put_nowait((kind, data))
+            except queue.Full:
+                pass
+        self.server.player.add_listener(listener)
+        try:
+            while True:
+                kind, data = events.get()
+                self.wfile.write((json.dumps({'event': kind, 'data': data}) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            self.server.player.remove_listener(listener)
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line.decode('utf-8'))
+                cmd = req['cmd']
+                if cmd == 'subscribe':
+                    return self.stream_events()
+                args = req.get('args', [])
+                if cmd == 'batch':
+                    result = self.server.actor.batch(*args)
+                elif cmd == 'stats':
+                    result = self.server.actor.stats()
+                elif cmd not in commands:
+                    raise ValueError('unknown command', cmd)
+                else:
+                    result = self.server.actor.call(cmd, *args)
+                if isinstance(result, Future):
+                    # e.g. beep, the client does not wait for completion
+                    result = None
+                resp = {'result': result}
+            except Exception as e:
+                logger.error("playerd: command failed: %s", e)
+                resp = {'error': str(e)}
+            self.wfile.write((json.dumps(resp) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class PlayerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, player):
+        self.player = player
+        # all libvlc and ALSA access of the player goes through the actor
+        self.actor = PlayerActor(player)
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, PlayerRequestHandler)
+        os.chmod(path, 0o660)
+
+
+class PlayerClient():
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        # one connection per client thread
+        self.local = threading.local()
+
+    def _close(self):
+        conn = getattr(self.local, 'conn', None)
+        self.local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def call(self, cmd, *args):
+        req = (json.dumps({'cmd': cmd, 'args': args}) + '\n').encode('utf-8')
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            reused = conn is not None
+            try:
+                if conn is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.timeout)
+                    sock.connect(self.path)
+                    conn = self.local.conn = sock.makefile('rwb')
+                conn.write(req)
+                conn.flush()
+                line = conn.readline()
+                if not line:
+                    raise ConnectionError('player daemon closed the connection')
+                break
+            except OSError:
+                self._close()
+                # only a stale connection is retried, otherwise the
+                # command might be executed twice
+                if not reused:
+                    raise
+        resp = json.loads(line.decode('utf-8'))
+        if 'error' in resp:
+            raise Exception('player daemon: ' + resp['error'])
+        return resp['result']
+
+    def batch(self, ops):
+        return self.call('batch', ops)
+
+    def stats(self):
+        return self.call('stats')
+
+    def _listen(self, callback):
+        # reconnects until the player daemon is available again
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                with sock.makefile('rwb') as conn:
+                    conn.write(b'{"cmd": "subscribe"}\n')
+                    conn.flush()
+                    for line in conn:
+                        ev = json.loads(line.decode('utf-8'))
+                        callback(ev['event'], ev['data'])
+            except (OSError, ValueError) as e:
+                logger.warning("playerd: event connection lost: %s", e)
+            finally:
+                sock.close()
+            time.sleep(1)
+
+    def add_listener(self, callback):
+        threading.Thread(target=self._listen, args=(callback,), name='playerd-events', daemon=True).start()
+
+    def __getattr__(self, name):
+        if name not in commands:
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+
+def is_running(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(path):
+    from vlcplayer import vlcplayer
+    server = PlayerServer(path, vlcplayer)
+    logger.info("playerd: listening on %s", path)
+    server.serve_forever()
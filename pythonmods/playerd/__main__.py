@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+#
+# playerd
+# Owner process of the VlcPlayer, see __init__.py
+
+import sys
+import logging
+from . import serve
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python3 -m playerd SOCKET")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    serve(sys.argv[1])
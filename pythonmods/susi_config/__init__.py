@@ -5,12 +5,50 @@
 
 import sys
 import os
+import time
+import ctypes
+import ctypes.util
+import tempfile
+import threading
+import contextlib
 import json_config
-import requests
 from pathlib import Path
 from importlib import util
 
+# cache directory of SUSI.AI, e.g. for downloaded songs and discovery results
+if 'XDG_CACHE_HOME' in os.environ:
+    cache_path = os.path.join(os.environ['XDG_CACHE_HOME'], 'SUSI.AI')
+else:
+    cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'SUSI.AI')
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+def inotify_waiter(directory):
+    """ Returns a function that blocks until something in directory has
+    changed, or None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+        os.close(fd)
+        return None
+    # the events only tell that something happened, the file is checked anyway
+    return lambda: os.read(fd, 4096)
+
+
 class SusiConfig():
+
+    # seconds between checks of config.json if inotify is not available
+    poll_interval = 1
     def __init__(self, conffile = None, data_dir = "."):
         if 'XDG_CONFIG_HOME' in os.environ:
             confdir = os.path.join(os.environ['XDG_CONFIG_HOME'], "SUSI.AI")
@@ -51,11 +89,14 @@ class SusiConfig():
             'path.sound.detection':         { 'default': 'susi_linux/extras/detection-bell.wav' },
             'path.sound.problem':           { 'default': 'susi_linux/extras/problem.wav' },
             'path.sound.error.recognition': { 'default': 'susi_linux/extras/recognition-error.wav' },
-            'path.sound.error.timeout':     { 'default': 'susi_linux/extras/error-tada.wav' }
+            'path.sound.error.timeout':     { 'default': 'susi_linux/extras/error-tada.wav' },
+            'audio.cards':                  { 'default': 'seeed' },
+            'audio.mixers':                 { 'default': 'Master,PCM,Speaker,Playback' }
         }
-        self.config = json_config.connect(self.conffile)
-        for k,v in self.defaults.items():
-            self.config.setdefault(k,v['default'])
+        self.load()
+        self.watch_lock = threading.Lock()
+        self.watchers = []
+        self.watch_thread = None
 
         self.susiai_path = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../.."))
 
@@ -93,7 +134,163 @@ class SusiConfig():
             self.config['hotword.engine'] = mode
     
     
+    def _stat(self):
+        try:
+            st = os.stat(self.conffile)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def load(self):
+        # stat before reading, so that a change while reading is noticed,
+        # but only remember it once the file could be parsed
+        stat = self._stat()
+        config = json_config.connect(self.conffile)
+        # all writes of config.json, also the automatic ones of json_config,
+        # go through our atomic save
+        config.save = self.save
+        for k,v in self.defaults.items():
+            config.setdefault(k,v['default'])
+        self.config = config
+        self.loaded = stat
+
+    def refresh(self):
+        """ Reads config.json again if it was changed since it was read,
+        e.g. by susi-config in another process. Returns True in this case.
+        If the file cannot be read or parsed, the current values are kept
+        and it is tried again on the next call.
+        """
+        if self.config._is_locked or self._stat() == self.loaded:
+            return False
+        try:
+            self.load()
+        except (OSError, ValueError) as e:
+            print(f"susi-config: cannot read {self.conffile}: {e}", file=sys.stderr)
+            return False
+        return True
+
+    def on_change(self, callback, keys = None):
+        """ callback(key, old, new) is called from a watcher thread when the
+        value of one of keys (all keys if None) changes in config.json.
+        """
+        with self.watch_lock:
+            self.watchers.append((callback, keys))
+            if self.watch_thread is None:
+                self.watch_thread = threading.Thread(target=self._watch, name='susi-config', daemon=True)
+                self.watch_thread.start()
+
+    def _watch(self):
+        wait = inotify_waiter(os.path.dirname(os.path.abspath(self.conffile)))
+        if wait is None:
+            wait = lambda: time.sleep(self.poll_interval)
+        # compared with the values last reported, other threads might
+        # have refreshed the configuration already
+        seen = dict(self.config)
+        while True:
+            wait()
+            self.refresh()
+            current = dict(self.config)
+            for k in set(seen) | set(current):
+                if seen.get(k) == current.get(k):
+                    continue
+                for callback, keys in list(self.watchers):
+                    if keys is None or k in keys:
+                        try:
+                            callback(k, seen.get(k), current.get(k))
+                        except Exception as e:
+                            print(f"susi-config: change callback for {k} failed: {e}", file=sys.stderr)
+            seen = current
+
+    def save(self):
+        # write to a temporary file and rename it, so that config.json is
+        # either the old or the new one, even after a power loss
+        confdir = os.path.dirname(os.path.abspath(self.conffile))
+        fd, tmp = tempfile.mkstemp(dir=confdir, prefix='.config.json.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.config.serialize())
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.conffile):
+                os.chmod(tmp, os.stat(self.conffile).st_mode & 0o777)
+            else:
+                os.chmod(tmp, 0o644)
+            os.replace(tmp, self.conffile)
+            self.loaded = self._stat()
+        except:
+            os.unlink(tmp)
+            raise
+        dirfd = os.open(confdir, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Changes done within the with block are written once at its end,
+        nothing is written if the block raises an exception.
+        """
+        if not self.config._is_locked:
+            self.refresh()
+        with self.config.lock() as owner:
+            yield self
+        if owner:
+            self.save()
+
+    def check(self, k, v):
+        """ Raises ValueError if set(k, v) would reject the value.
+        """
+        if not k in self.defaults:
+            raise ValueError('unknown key', k)
+        if k == 'wakebutton':
+            accepted = [ 'y', 'n', 'enable', 'disable' ]
+        elif k == 'hotword.engine':
+            accepted = [ 'y', 'n', 'Snowboy', 'PocketSphinx', 'None' ]
+        else:
+            accepted = self.defaults[k].get('options')
+        if accepted is not None and not (v in accepted):
+            raise ValueError(f"unsupported value for {k}", v)
+
+    def update(self, values):
+        """ Sets several keys from a dict, all values are checked before
+        anything is changed, and config.json is written once.
+        """
+        values = dict(values)
+        for k,v in values.items():
+            self.check(k, v)
+        with self.transaction():
+            for k,v in values.items():
+                self.get_set(k, v)
+
+    def export_values(self):
+        """ All keys with their values as stored in config.json.
+        """
+        self.refresh()
+        return { k: self.config[k] for k in self.defaults }
+
+    def import_values(self, values):
+        """ Stores the values of a dict as they are, e.g. from export_values().
+        Every key must be known and every value a string, one of the options
+        if the key has some. Nothing is changed if one of them is invalid,
+        keys not in values keep their current value.
+        """
+        if not isinstance(values, dict):
+            raise ValueError('configuration is not a JSON object')
+        for k,v in values.items():
+            if not k in self.defaults:
+                raise ValueError('unknown key', k)
+            if not isinstance(v, str):
+                raise ValueError(f"value for {k} is not a string", v)
+            if 'options' in self.defaults[k] and not (v in self.defaults[k]['options']):
+                raise ValueError(f"unsupported value for {k}", v)
+        with self.transaction():
+            for k,v in values.items():
+                self.config[k] = v
+
     def get(self, k):
+        # values are read from memory as long as config.json is unchanged
+        self.refresh()
         return self.get_set(k)
 
     def set(self, k, v):
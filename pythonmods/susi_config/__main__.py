@@ -12,6 +12,7 @@
 import sys
 import os
 import re
+import json
 import logging
 import subprocess
 import shutil
@@ -31,6 +32,12 @@ Usage:
          Retrieves a set of keys, all if no argument is given
   susi-config set key=value [ key=value ... ]
          Sets a set of keys to values
+  susi-config export --json
+         Prints all keys with their values as one JSON object
+  susi-config import FILE|-
+         Stores the keys and values of a JSON object as written by export,
+         read from FILE or standard input. Nothing is changed if a key or
+         value is invalid, keys not given keep their value
   susi-config login
          Tries to log into the SUSI.AI Server
   susi-config (un)install links DIR
@@ -377,15 +384,15 @@ def main(args):
 
         elif args[1] == 'set':
             cfg = SusiConfig()
-            ans = [ "Values set to:" ]
+            values = []
             for kv in args[2:]:
-                k,v = kv.split('=', 2)
-                if k in cfg.defaults:
-                    pass
-                else:
-                    raise ValueError('unknown key', k)
-                newv = cfg.get_set(k,v)
-                ans.append(f"  {k} = {newv} (requested {v})")
+                k,v = kv.split('=', 1)
+                values.append((k,v))
+            # nothing is changed if one of the values is invalid
+            cfg.update(values)
+            ans = [ "Values set to:" ]
+            for k,v in values:
+                ans.append(f"  {k} = {cfg.get_set(k)} (requested {v})")
             print("\n".join(ans))
 
         elif args[1] == 'get':
@@ -404,6 +411,26 @@ def main(args):
             for i in ret:
                 print(i)
 
+        elif args[1] == 'export':
+            if args[2:] != [ '--json' ]:
+                raise ValueError("export needs the --json option", args[2:])
+            cfg = SusiConfig()
+            print(json.dumps(cfg.export_values(), indent=2, sort_keys=True))
+
+        elif args[1] == 'import':
+            if len(args) != 3:
+                raise ValueError("import needs one FILE or -", args[2:])
+            try:
+                if args[2] == '-':
+                    values = json.load(sys.stdin)
+                else:
+                    with open(args[2]) as f:
+                        values = json.load(f)
+            except OSError as e:
+                raise ValueError("cannot read configuration", args[2], e.strerror)
+            cfg = SusiConfig()
+            cfg.import_values(values)
+
         elif args[1] == 'login':
             cfg = SusiConfig()
             if len(args) > 2:
@@ -425,11 +452,12 @@ def main(args):
                 raise ValueError("unsupported options to init", args[2:])
 
             cfg = SusiConfig()
-            for k,v in cfg.defaults.items():
-                if force:
-                    cfg.config[k] = v['default']
-                else:
-                    cfg.config.setdefault(k,v['default'])
+            with cfg.transaction():
+                for k,v in cfg.defaults.items():
+                    if force:
+                        cfg.config[k] = v['default']
+                    else:
+                        cfg.config.setdefault(k,v['default'])
 
         elif args[1] == 'install' or args[1] == 'uninstall':
             install_uninstall(args)
@@ -2,16 +2,26 @@
 
 import os
 import logging
+import hashlib
+import tempfile
 import time
 import random
-
-import pafy
-import vlc
-
-from hwmixer import mixer
+import re
+import queue
+import threading
+import array
+import functools
+import collections
+from concurrent.futures import Future
+
+import hwmixer
 import urllib.parse
-import requests
-import xml
+from susi_config import cache_path
+
+# vlc, pafy, sclib and requests are imported on first use: they take long
+# to import, and creating the player grabs the sound device. The player
+# itself is created on first access of vlcplayer.vlcplayer.
+vlc = None
 
 #
 # we have two mixers available
@@ -35,158 +45,638 @@ import xml
 
 logger = logging.getLogger(__name__)
 
-try:
-    from sclib import SoundcloudAPI, Track
-    sclib_available = True
-except ImportError:
-    logger.warning("vlcplayer: SoundCloudAPI not available")
-    sclib_available = False
+def state_name(state):
+    # vlc.State.Playing -> 'Playing'
+    return str(state).split('.')[-1]
+
+class Playlist():
+
+    # The tracks are kept as the original ;-separated string together with
+    # an array of the start offsets, no per-track objects are created.
+    def __init__(self, mrl_string):
+        self.mrls = mrl_string
+        self.starts = array.array('L', [0])
+        pos = mrl_string.find(';')
+        while pos >= 0:
+            self.starts.append(pos + 1)
+            pos = mrl_string.find(';', pos + 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if i + 1 < len(self.starts):
+            return self.mrls[self.starts[i]:self.starts[i + 1] - 1]
+        return self.mrls[self.starts[i]:]
+
+
+class ShuffleOrder():
+
+    # A random permutation of n tracks that starts with track `first`. It is
+    # generated by a Fisher-Yates shuffle that only runs as far as positions
+    # are asked for; only the swapped entries are stored.
+    def __init__(self, n, first):
+        self.n = n
+        self.swaps = {}
+        self.generated = 0
+        self._swap(0, first)
+        self.generated = 1
+
+    def _swap(self, i, j):
+        vi = self.swaps.get(i, i)
+        self.swaps[i] = self.swaps.get(j, j)
+        self.swaps[j] = vi
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, pos):
+        while self.generated <= pos:
+            self._swap(self.generated, random.randrange(self.generated, self.n))
+            self.generated += 1
+        return self.swaps.get(pos, pos)
+
+
+class VolumeRamps():
+
+    # Volume ramps of libvlc players run on one thread which adjusts all
+    # active ramps every `tick` seconds. A new ramp for a player replaces
+    # the running one and starts from the volume reached so far.
+    tick = 0.03
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.ramps = {}
+        self.thread = None
+
+    def ramp(self, pl, target, duration):
+        f = Future()
+        with self.cond:
+            prev = self.ramps.pop(pl, None)
+            self.ramps[pl] = (pl.audio_get_volume(), target, time.monotonic(), duration, f)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='volumeramps', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        if prev is not None:
+            prev[4].set_result(False)
+        return f
+
+    # the volume a running ramp of pl is heading to, None without ramp
+    def target(self, pl):
+        with self.cond:
+            ramp = self.ramps.get(pl)
+        return None if ramp is None else ramp[1]
+
+    def cancel(self, pl):
+        with self.cond:
+            prev = self.ramps.pop(pl, None)
+        if prev is not None:
+            prev[4].set_result(False)
+
+    def _run(self):
+        while True:
+            finished = []
+            with self.cond:
+                while not self.ramps:
+                    self.cond.wait()
+                now = time.monotonic()
+                for pl, (start, target, t0, duration, f) in list(self.ramps.items()):
+                    frac = 1 if duration <= 0 else min(1, (now - t0) / duration)
+                    pl.audio_set_volume(round(start + (target - start) * frac))
+                    if frac >= 1:
+                        del self.ramps[pl]
+                        finished.append(f)
+            for f in finished:
+                f.set_result(True)
+            time.sleep(self.tick)
+
+
+class PlayTimings():
+
+    # Timeline of the current play request: when it was received, when the
+    # MRL was resolved and handed to libvlc, and the first Opening, Buffering
+    # and Playing events. Finished timelines are aggregated per source.
+    marks = ('resolved', 'opening', 'buffering', 'playing')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+        self.sources = {}
+
+    def start(self, source):
+        with self.lock:
+            self.current = {'source': source, 'received': time.monotonic()}
+
+    # called from libvlc callbacks, thus must not call into libvlc
+    def mark(self, name):
+        with self.lock:
+            t = self.current
+            if t is None or name in t:
+                return
+            t[name] = time.monotonic()
+            if name == 'playing':
+                self._finish(t, True)
+
+    def fail(self):
+        with self.lock:
+            if self.current is not None:
+                self._finish(self.current, False)
+
+    def _finish(self, t, ok):
+        self.current = None
+        s = self.sources.setdefault(t['source'], {'count': 0, 'failed': 0, 'phases': {}})
+        if not ok:
+            s['failed'] += 1
+            logger.info("vlcplayer: %s: play request failed after %.3fs", t['source'], time.monotonic() - t['received'])
+            return
+        s['count'] += 1
+        phases = []
+        for name in self.marks:
+            if name in t:
+                d = t[name] - t['received']
+                p = s['phases'].setdefault(name, [0, 0.0, 0.0])
+                p[0] += 1
+                p[1] += d
+                p[2] = max(p[2], d)
+                phases.append("%s %.3fs" % (name, d))
+        logger.info("vlcplayer: %s: first audio after %.3fs (%s)", t['source'],
+                    t['playing'] - t['received'], ', '.join(phases))
+
+    def summary(self):
+        # seconds since the request was received, per source and phase
+        with self.lock:
+            return { source: { 'count': s['count'], 'failed': s['failed'],
+                               'phases': { name: { 'avg': round(p[1] / p[0], 4), 'max': round(p[2], 4) }
+                                           for name, p in s['phases'].items() } }
+                     for source, s in self.sources.items() }
+
 
 class VlcPlayer():
 
+    # seconds for turning the music down when saying something, and up again
+    duck_fade = 0.2
+    restore_fade = 0.5
+
+    # number of upcoming tracks for which media objects are prepared
+    window = 2
+
     def __init__(self):
+        # all other uses of vlc are in methods of the player
+        global vlc
+        import vlc
         self.saved_softvolume = -1
         self.saved_hardvolume = -1
+        # the playlist, the play order (None means in sequence), the current
+        # position within the order and the media objects of the window
+        self.playlist = Playlist('')
+        self.shuffled = False
+        self.order = None
+        self.position = -1
+        self.window_media = {}
+        self.playlist_lock = threading.RLock()
         self.instance = vlc.Instance("--no-video")
         self.player = self.instance.media_player_new()
         self.sayplayer = self.instance.media_player_new()
-        self.list_player =  self.instance.media_list_player_new()
-        self.list_player.set_media_player(self.player)
-        if sclib_available:
+        self.ramps = VolumeRamps()
+        self.timings = PlayTimings()
+        try:
+            from sclib import SoundcloudAPI
             self.sc_api = SoundcloudAPI()
+        except ImportError:
+            logger.warning("vlcplayer: SoundCloudAPI not available")
+            self.sc_api = None
+        # libvlc callbacks must not call back into libvlc, so they only
+        # queue the kind of change, and a dispatcher thread collects the
+        # new values and informs the listeners
+        self.listeners = []
+        self.events = queue.Queue()
+        # completion of the current say() is tracked via events of its media
+        self.say_lock = threading.Lock()
+        self.say_future = None
+        self.say_media = None
+        # (media, EventManager) of the current say if it is not a preloaded
+        # sound, the callbacks only work as long as the manager is alive
+        self.say_events = None
+        self.say_restore = False
+        self.ducked = False
+        # short notification sounds, kept as ready to play (media, EventManager)
+        self.sounds = {}
+        for path in configured_sounds():
+            self.preload(path)
+        # event_manager() returns a new wrapper each time, and the callbacks
+        # are only referenced by it, so it has to live as long as the player
+        em = self.player_events = self.player.event_manager()
+        for ev in (vlc.EventType.MediaPlayerOpening, vlc.EventType.MediaPlayerPlaying,
+                   vlc.EventType.MediaPlayerPaused, vlc.EventType.MediaPlayerStopped,
+                   vlc.EventType.MediaPlayerEndReached, vlc.EventType.MediaPlayerEncounteredError):
+            em.event_attach(ev, self._vlc_event, 'state')
+        em.event_attach(vlc.EventType.MediaPlayerAudioVolume, self._vlc_event, 'softvolume')
+        em.event_attach(vlc.EventType.MediaPlayerBuffering, self._vlc_event, None)
+        # hardware volume changes, also by other programs
+        hwmixer.mixer.add_listener(lambda vol: self.events.put('hardvolume'))
+        threading.Thread(target=self._dispatch_events, name='vlcevents', daemon=True).start()
+
+    def _vlc_event(self, event, kind):
+        if event.type == vlc.EventType.MediaPlayerOpening:
+            self.timings.mark('opening')
+        elif event.type == vlc.EventType.MediaPlayerBuffering:
+            self.timings.mark('buffering')
+        elif event.type == vlc.EventType.MediaPlayerPlaying:
+            self.timings.mark('playing')
+        elif event.type == vlc.EventType.MediaPlayerEncounteredError:
+            self.timings.fail()
+        if kind is not None:
+            self.events.put(kind)
+        if event.type in (vlc.EventType.MediaPlayerEndReached, vlc.EventType.MediaPlayerEncounteredError):
+            self.events.put(self._advance)
+
+    def _event_data(self, kind):
+        if kind == 'state':
+            return {'state': state_name(self.player.get_state())}
+        elif kind == 'item':
+            index, mrl = self.current_item()
+            return {'index': index, 'mrl': mrl}
+        elif kind == 'softvolume':
+            return {'volume': self.softvolume(None, self.player)}
+        elif kind == 'hardvolume':
+            return {'volume': hwmixer.mixer.volume(None)}
+
+    def _dispatch_events(self):
+        last = {}
+        while True:
+            kind = self.events.get()
+            if callable(kind):
+                # work handed over from libvlc callbacks
+                try:
+                    kind()
+                except Exception as e:
+                    logger.error("vlcplayer: event handling failed: %s", e)
+                continue
+            if not self.listeners:
+                last.clear()
+                continue
+            try:
+                data = self._event_data(kind)
+            except Exception as e:
+                logger.debug("vlcplayer: cannot determine %s: %s", kind, e)
+                continue
+            if last.get(kind) == data:
+                continue
+            last[kind] = data
+            for cb in list(self.listeners):
+                try:
+                    cb(kind, data)
+                except Exception as e:
+                    logger.error("vlcplayer: event listener failed: %s", e)
+
+    # callback(kind, data) is called for changes of the player, with kind
+    # being one of state, item, softvolume or hardvolume
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def current_item(self):
+        with self.playlist_lock:
+            if self.position < 0:
+                return -1, None
+            track = self._track(self.position)
+            return track, self.playlist[track]
+
+    def _track(self, position):
+        if self.order is None:
+            return position
+        return self.order[position]
+
+    def _play_position(self, position):
+        with self.playlist_lock:
+            self.position = position
+            tracks = [self._track(p) for p in range(position, min(position + 1 + self.window, len(self.playlist)))]
+            # keep only the media objects of the current window
+            self.window_media = { t: self.window_media.get(t) or self.instance.media_new(self.playlist[t])
+                                  for t in tracks }
+            self.player.set_media(self.window_media[tracks[0]])
+            self.player.play()
+        self.events.put('item')
+
+    def _advance(self):
+        # the current track has ended, continue with the next one
+        with self.playlist_lock:
+            if 0 <= self.position < len(self.playlist) - 1:
+                self._play_position(self.position + 1)
+
+    def status(self):
+        index, mrl = self.current_item()
+        return {
+            'state': state_name(self.player.get_state()),
+            'index': index,
+            'mrl': mrl,
+            'shuffle': self.shuffled,
+            'softvolume': self.softvolume(None, self.player),
+            'hardvolume': hwmixer.mixer.volume(None)
+        }
+
+    # time to first audio of the play requests, per source
+    def play_stats(self):
+        return self.timings.summary()
+
+    # Looks up what to play for a play command, returns the mrl or None if
+    # there is nothing to play. This can take seconds (YouTube, SoundCloud,
+    # TuneIn) but does not use libvlc, so playerd calls it outside of the
+    # thread that drives the player. A lookup that fails or raises is
+    # counted as failed in the timings.
+    def resolve(self, cmd, *args):
+        if cmd == 'play':
+            mrl_string = args[0]
+            source = 'file' if mrl_string.startswith('file:') or mrl_string.startswith('/') else 'mrl'
+            lookup = lambda mrl: mrl
+        elif cmd == 'playytb':
+            source, lookup = 'ytb', vid2youtubeMRL
+        elif cmd == 'playytbLink':
+            source, lookup = 'ytb', link2youtubeMRL
+        elif cmd == 'playscloud':
+            source, lookup = 'scloud', self._resolvescloud
+        elif cmd == 'playtunein':
+            source, lookup = 'tunein', self._resolvetunein
+        else:
+            raise ValueError('not a play command: ' + cmd)
+        self.timings.start(source)
+        try:
+            mrl = lookup(*args)
+        except Exception:
+            self.timings.fail()
+            raise
+        if mrl is None:
+            self.timings.fail()
+        return mrl
+
+    # plays what resolve() returned, True if something is played
+    def play_resolved(self, mrl):
+        if mrl is None:
+            return(False)
+        try:
+            self._play(mrl)
+        except Exception:
+            self.timings.fail()
+            raise
+        return(True)
+
+    def play(self, mrl_string):
+        return self.play_resolved(self.resolve('play', mrl_string))
 
     def playytb(self, vid):
-        self.play(vid2youtubeMRL(vid))
+        return self.play_resolved(self.resolve('playytb', vid))
     
     def playytbLink(self, link):
-        self.play(link2youtubeMRL(link))
+        return self.play_resolved(self.resolve('playytbLink', link))
+
+    def prefetchytb(self, vid):
+        prefetch_youtube(vid)
+
+    def prefetchytbLink(self, link):
+        prefetch_youtube_link(link)
 
     def playscloud(self, identifier):
-        if not sclib_available:
-            return(False)
+        return self.play_resolved(self.resolve('playscloud', identifier))
+
+    def _resolvescloud(self, identifier):
+        if self.sc_api is None:
+            return None
         #Url of the format: https://soundcloud.com/aries_ix/sayonara
-        url = "https://souncloud.com" + identifier
+        url = "https://soundcloud.com" + identifier
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        filename = soundcloud_cache.lookup(key)
+        if filename:
+            return filename
+        from sclib import Track
         track = self.sc_api.resolve(url)
-        try:
-            assert type(track) is Track
-        except AssertionError as error:
-            logger.debug(error)
-        
-        filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),"download.mp3")
-        with open(filename, "wb+") as fp:
-            track.write_mp3_to(fp)
-        self.play(filename)
-
-    def play(self, mrl_string):
-        self.mrl = mrl_string.split(";")
-        media_list = self.instance.media_list_new(self.mrl)
-        self.list_player.set_media_list(media_list)
-        self.list_player.play()
+        if type(track) is not Track:
+            logger.debug("vlcplayer: %s is not a SoundCloud track", url)
+            return None
+        if hasattr(track, 'get_stream_url'):
+            # start playing from the stream right away, and fill the cache
+            # in the background for the next time; this fetches the track
+            # a second time while it is streamed
+            threading.Thread(target=soundcloud_cache.store, args=(key, track.write_mp3_to),
+                             daemon=True).start()
+            return track.get_stream_url()
+        return soundcloud_cache.store(key, track.write_mp3_to) or None
+
+    def _play(self, mrl_string):
+        self.timings.mark('resolved')
+        with self.playlist_lock:
+            self.playlist = Playlist(mrl_string)
+            if self.shuffled:
+                self.order = ShuffleOrder(len(self.playlist), random.randrange(len(self.playlist)))
+            else:
+                self.order = None
+            self.window_media = {}
+            self._play_position(0)
         self.softvolume(100, self.player)
 
     def playtunein(self, query_name):
+        return self.play_resolved(self.resolve('playtunein', query_name))
+
+    def _resolvetunein(self, query_name):
+        import requests
+        import xml.dom.minidom
         base_url = "http://opml.radiotime.com/Search.ashx?query=" + \
             urllib.parse.urlencode(query_name)
         resp = requests.get(base_url)
         resp_list = xml.dom.minidom.parse(resp)
         resp_list = resp_list.getElementsByTagName("outline")
         if not resp_list:
-            return
+            return None
         
-        playing_mrl = resp_list[0].getAttribute("URL")
-        self.play(playing_mrl)
+        return resp_list[0].getAttribute("URL")
         # playing_mrl = requests.get(playing_url)
 
 
     def next(self):
-        if self.is_playing():
-            self.list_player.next()
+        with self.playlist_lock:
+            if self.is_playing() and self.position < len(self.playlist) - 1:
+                self._play_position(self.position + 1)
 
     def previous(self):
-        if self.is_playing():
-            self.list_player.previous()
+        with self.playlist_lock:
+            if self.is_playing() and self.position > 0:
+                self._play_position(self.position - 1)
 
     def restart(self):
-        if self.is_playing():
-            self.list_player.previous()
-            time.sleep(0.01)
-            self.list_player.next()
-
-    def shuffle(self):
-        if self.is_playing():
-            self.list_player.stop()
-            random.shuffle(self.mrl)
-            media_list = self.instance.media_list_new(self.mrl)
-            self.list_player.set_media_list(media_list)
-            self.list_player.play()
-            self.softvolume(100, self.player)
+        with self.playlist_lock:
+            if self.is_playing():
+                self._play_position(self.position)
+
+    # switches shuffle mode on or off, toggles it without argument; the
+    # current track continues to play
+    def shuffle(self, mode = None):
+        with self.playlist_lock:
+            if mode is None:
+                self.shuffled = not self.shuffled
+            elif mode in ('on', 'off'):
+                self.shuffled = (mode == 'on')
+            else:
+                raise Exception('Invalid argument to shuffle: ' + str(mode))
+            if self.position < 0:
+                return self.shuffled
+            track = self._track(self.position)
+            if self.shuffled:
+                # the tracks played so far are not part of the history
+                self.order = ShuffleOrder(len(self.playlist), track)
+                self.position = 0
+            else:
+                self.order = None
+                self.position = track
+            return self.shuffled
 
     def pause(self):
         if self.is_playing():
-            self.list_player.pause()
+            self.player.set_pause(1)
 
     def resume(self):
-        # pause works like a button, thus doing both pause and resume
         if not self.is_playing():
-            self.list_player.pause()
+            self.player.set_pause(0)
 
     def stop(self):
-        self.list_player.stop()
-
-    def wait_till_end(self, pl):
-        playing = set([vlc.State.Playing, vlc.State.Buffering, vlc.State.Opening])
-        # wait some time to give vlc a chance to start up
-        time.sleep(0.3)
-        time_left = True
-        while time_left == True:
-            pstate = pl.get_state()
-            if pstate not in playing:
-                time_left = False
-            # print("Sleeping for audio output")
-            time.sleep(0.1)
+        self.player.stop()
 
     def is_playing(self):
-        return self.list_player.is_playing()
+        return bool(self.player.is_playing())
+
+    def preload(self, path):
+        if not os.path.isfile(path):
+            logger.debug("vlcplayer: sound %s not found, not preloading", path)
+            return False
+        path = os.path.abspath(path)
+        # reading the file once keeps it in the page cache
+        with open(path, 'rb') as f:
+            f.read()
+        media = self.instance.media_new(path)
+        media.parse_with_options(vlc.MediaParseFlag.local, 0)
+        em = media.event_manager()
+        em.event_attach(vlc.EventType.MediaStateChanged, self._say_media_event, media)
+        self.sounds[path] = (media, em)
+        self.sounds['file://' + path] = (media, em)
+        return True
 
     def beep(self, mrl):
-        self.save_softvolume()
-        self.say(mrl, False)
+        self.say_async(mrl, False)
 
     def say(self, mrl, wait_restore = True):
-        self.save_softvolume()
-        if (self.list_player.is_playing()):
-            # reduce volume to 20% of the current volume
-            self.softvolume(int(0.2 * self.saved_softvolume), self.player)
-            time.sleep(0.2)
+        f = self.say_async(mrl, wait_restore)
+        if wait_restore:
+            logger.debug("vlcplayer: waiting for player to be finished")
+            f.result()
+        logger.debug("vlcplayer: finished saying")
+
+    def _say_media_event(self, event, media):
+        state = event.u.new_state
+        if state == vlc.State.Ended:
+            self.events.put(functools.partial(self._say_media_finished, media, 'ended'))
+        elif state == vlc.State.Error:
+            self.events.put(functools.partial(self._say_media_finished, media, 'error'))
+        elif state == vlc.State.Stopped:
+            self.events.put(functools.partial(self._say_media_finished, media, 'stopped'))
+
+    def _say_media_finished(self, media, result):
+        # events of a media that is no longer said are ignored
+        with self.say_lock:
+            if media is not self.say_media:
+                return
+            f = self.say_future
+        self._say_finished(f, result)
+
+    def _say_finished(self, f, result):
+        with self.say_lock:
+            if f.done():
+                return
+            restore = (f is self.say_future) and self.say_restore
+        if restore:
+            self.restore_softvolume()
+        # the future might have been replaced meanwhile
+        with self.say_lock:
+            if not f.done():
+                f.set_result(result)
+
+    # Plays mrl on top of the music, which is turned down meanwhile. Returns
+    # a Future that is resolved with 'ended', 'error', 'stopped' or 'replaced'
+    # (by a following say) as soon as playback finished and, if restore is
+    # given, the music volume is restored.
+    def say_async(self, mrl, restore = True):
+        f = Future()
+        sound = self.sounds.get(mrl)
+        if sound is None:
+            media = self.instance.media_new(mrl)
+            em = media.event_manager()
+            em.event_attach(vlc.EventType.MediaStateChanged, self._say_media_event, media)
+            own = (media, em)
+        else:
+            media = sound[0]
+            own = None
+        with self.say_lock:
+            prev = self.say_future
+            # if the music is still turned down by a previous say, keep
+            # the volume saved back then
+            if not self.ducked:
+                self.save_softvolume()
+                if (self.is_playing()):
+                    # reduce volume to 20% of the current volume
+                    self.softvolume(int(0.2 * self.saved_softvolume), self.player, self.duck_fade)
+                    self.ducked = True
+            # a replaced say that would have restored the volume leaves
+            # this to the one replacing it
+            prev_restore = prev is not None and not prev.done() and self.say_restore
+            self.say_future = f
+            self.say_restore = restore or prev_restore
+            self.say_media = media
+            prev_events = self.say_events
+            self.say_events = own
+            if prev is not None and not prev.done():
+                prev.set_result('replaced')
+        if prev_events is not None:
+            # no callbacks into the manager that is dropped now
+            prev_events[1].event_detach(vlc.EventType.MediaStateChanged)
         # play additional stream via sayplayer
-        media = self.instance.media_new(mrl)
         self.sayplayer.set_media(media)
         logger.debug("vlcplayer: starting to say something!")
-        self.sayplayer.play()
+        if self.sayplayer.play() == -1:
+            self._say_finished(f, 'error')
+            return f
         if self.saved_softvolume > 0:
             self.softvolume(self.saved_softvolume, self.sayplayer)
         else:
             self.softvolume(100, self.sayplayer)
-        if wait_restore:
-            logger.debug("vlcplayer: waiting for player to be finished")
-            self.wait_till_end(self.sayplayer)
-            self.restore_softvolume()
-        logger.debug("vlcplayer: finished saying")
+        return f
 
     def volume(self, val):
-        return mixer.volume(val)
+        ret = hwmixer.mixer.volume(val)
+        self.events.put('hardvolume')
+        return ret
 
-    def softvolume(self, val, pl):
+    # with fade > 0 the volume is changed gradually over fade seconds in the
+    # background, the returned value is the target volume
+    def softvolume(self, val, pl, fade = 0):
         if (val is None):
-            absvol = mixer.volume(None)
-            sf = pl.audio_get_volume()
+            absvol = hwmixer.mixer.volume(None)
+            # while fading, e.g. restoring after a say, the volume reached so
+            # far must not be taken (and saved) as the volume
+            sf = self.ramps.target(pl)
+            if sf is None:
+                sf = pl.audio_get_volume()
             # sometimes the softvolume is bigger than 100 while hw volume is 100, catch that
             return min( 100, int(sf * 100 / absvol) )
         elif ((isinstance(val, int) or val.isdigit()) and (int(val) <= 100) and (int(val) >= 0)):
             p = int(val)
-            absvol = mixer.volume(None)
+            absvol = hwmixer.mixer.volume(None)
             softvol = min(absvol, round(absvol * p / 100))
-            pl.audio_set_volume(softvol)
+            if fade > 0:
+                self.ramps.ramp(pl, softvol, fade)
+            else:
+                self.ramps.cancel(pl)
+                pl.audio_set_volume(softvol)
             return(softvol)
         else:
             raise Exception('Invalid argument to softvolume: ' + str(val))
@@ -196,31 +686,227 @@ class VlcPlayer():
         return self.saved_softvolume
 
     def restore_softvolume(self):
+        self.ducked = False
         if (self.saved_softvolume >= 0):
-            self.softvolume(self.saved_softvolume, self.player)
+            self.softvolume(self.saved_softvolume, self.player, self.restore_fade)
         return self.saved_softvolume
 
     def save_hardvolume(self):
-        self.saved_hardvolume = mixer.volume(None)
+        self.saved_hardvolume = hwmixer.mixer.volume(None)
         return self.saved_hardvolume
 
     def restore_hardvolume(self):
         if (self.saved_hardvolume >= 0):
-            mixer.volume(self.saved_hardvolume)
+            hwmixer.mixer.volume(self.saved_hardvolume)
+            self.events.put('hardvolume')
         return self.saved_hardvolume
 
     
 
-def vid2youtubeMRL(vid):
-    url = 'https://www.youtube.com/watch?v=' + vid
+class DiskCache():
+
+    # Files are stored under the hash of their source and evicted least
+    # recently used first once the cache grows beyond maxsize bytes.
+    # Temporary files of downloads that did not finish, e.g. because of a
+    # power loss, are removed once untouched for stale_part seconds.
+    stale_part = 3600
+    def __init__(self, path, suffix='', maxsize=200 * 1024 * 1024):
+        self.path = path
+        self.suffix = suffix
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # key -> Future of the download in progress
+        self.pending = {}
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def lookup(self, key):
+        filename = self._filename(key)
+        try:
+            # the mtime serves as time of last use
+            os.utime(filename)
+        except OSError:
+            return None
+        return filename
+
+    def store(self, key, write):
+        # write(fp) produces the content; it goes to a temporary file
+        # first so that concurrent readers never see partial files.
+        # Returns the filename or None if the download failed; concurrent
+        # calls for the same key wait for the first one.
+        filename = self._filename(key)
+        with self.lock:
+            if key in self.pending:
+                f = self.pending[key]
+                owner = False
+            else:
+                f = self.pending[key] = Future()
+                owner = True
+        if not owner:
+            return f.result()
+        stored = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.path, suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    write(fp)
+                os.replace(tmpname, filename)
+            except BaseException:
+                os.remove(tmpname)
+                raise
+            stored = filename
+        except Exception as e:
+            logger.error("vlcplayer: cannot store %s in cache: %s", key, e)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            f.set_result(stored)
+        if stored:
+            self.evict()
+        return stored
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        with os.scandir(self.path) as it:
+            for e in it:
+                if not e.is_file():
+                    continue
+                st = e.stat()
+                if not e.name.endswith('.part'):
+                    entries.append((st.st_mtime, st.st_size, e.path))
+                elif now - st.st_mtime > self.stale_part:
+                    try:
+                        os.remove(e.path)
+                    except OSError:
+                        pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+soundcloud_cache = DiskCache(os.path.join(cache_path, 'soundcloud'), '.mp3')
+
+def configured_sounds():
+    # the path.sound.* files of the SUSI.AI configuration
+    try:
+        from susi_config import SusiConfig
+        cfg = SusiConfig()
+        base = cfg.get('path.base')
+        return [os.path.join(base, cfg.get(k)) for k in cfg.defaults if k.startswith('path.sound.')]
+    except Exception as e:
+        logger.warning("vlcplayer: cannot determine sounds to preload: %s", e)
+        return []
+
+class MRLCache():
+
+    # Resolved stream URLs are kept until they expire, at most `maxsize`
+    # of them, dropping the least recently used one. Concurrent requests
+    # for the same key share one resolution.
+    def __init__(self, maxsize=64, default_ttl=3600, margin=120):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+
+    def expires(self, mrl):
+        # googlevideo URLs carry their expiry time as expire=<epoch>
+        m = re.search(r'[?&/]expire[=/](\d+)', mrl)
+        if m:
+            return int(m.group(1)) - self.margin
+        return time.time() + self.default_ttl
+
+    def _future(self, key):
+        # returns the future for key and whether the caller has to resolve it
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.entries.move_to_end(key)
+                    f = Future()
+                    f.set_result(entry[0])
+                    return f, False
+                del self.entries[key]
+            if key in self.pending:
+                return self.pending[key], False
+            f = self.pending[key] = Future()
+            return f, True
+
+    def _resolve(self, key, resolve, f):
+        try:
+            mrl = resolve()
+        except Exception as e:
+            with self.lock:
+                del self.pending[key]
+            f.set_exception(e)
+            return
+        with self.lock:
+            self.entries[key] = (mrl, self.expires(mrl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            del self.pending[key]
+        f.set_result(mrl)
+
+    def get(self, key, resolve):
+        f, owner = self._future(key)
+        if owner:
+            self._resolve(key, resolve, f)
+        return f.result()
+
+    def prefetch(self, key, resolve):
+        f, owner = self._future(key)
+        if owner:
+            threading.Thread(target=self._resolve, args=(key, resolve, f), daemon=True).start()
+        return f
+
+
+youtube_cache = MRLCache()
+
+def youtube_id(url):
+    m = re.search(r'(?:[?&]v=|youtu\.be/|/embed/|/shorts/)([A-Za-z0-9_-]{11})', url)
+    return m.group(1) if m else url
+
+def resolve_youtube(url):
+    import pafy
     video = pafy.new(url)
     best = video.getbestaudio()
     return best.url
 
+def vid2youtubeMRL(vid):
+    url = 'https://www.youtube.com/watch?v=' + vid
+    return youtube_cache.get(vid, lambda: resolve_youtube(url))
+
 def link2youtubeMRL(url):
-    video = pafy.new(url)
-    best = video.getbestaudio()
-    return best.url
+    return youtube_cache.get(youtube_id(url), lambda: resolve_youtube(url))
+
+# resolve in the background, e.g. for the next song of a queue,
+# returns a Future of the MRL
+def prefetch_youtube(vid):
+    url = 'https://www.youtube.com/watch?v=' + vid
+    return youtube_cache.prefetch(vid, lambda: resolve_youtube(url))
+
+def prefetch_youtube_link(url):
+    return youtube_cache.prefetch(youtube_id(url), lambda: resolve_youtube(url))
+
 
+player_lock = threading.Lock()
 
-vlcplayer = VlcPlayer()
+def __getattr__(name):
+    # module attribute hook (PEP 562), creates the player singleton
+    if name != 'vlcplayer':
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    with player_lock:
+        if 'vlcplayer' not in globals():
+            globals()['vlcplayer'] = VlcPlayer()
+    return globals()['vlcplayer']
@@ -19,9 +19,6 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 susicfg = SusiConfig()
-user = susicfg.get('susi.user')
-password = susicfg.get('susi.pass')
-room = susicfg.get('roomname')
 
 def get_token(login,password):
     url = 'http://api.susi.ai/aaa/login.json?type=access-token'
@@ -48,8 +45,10 @@ def device_register(access_token,room):
 
 for i in range(3):
     try:
-        access_token=get_token(user,password)
-        out=device_register(access_token,room)
+        # re-read for every attempt, the credentials might have been
+        # changed in the meantime
+        access_token=get_token(susicfg.get('susi.user'),susicfg.get('susi.pass'))
+        out=device_register(access_token,susicfg.get('roomname'))
         logger.debug(str(out))
         break
     except:
@@ -58,9 +57,7 @@ for i in range(3):
             logger.warning("Failed to register the device,retrying.")
         else:
             logger.warning("Resetting the device to hotspot mode")
-            susicfg.set('susi.mode', 'anonymous')
-            susicfg.set('susi.user', '')
-            susicfg.set('susi.pass', '')
+            susicfg.update({'susi.mode': 'anonymous', 'susi.user': '', 'susi.pass': ''})
             subprocess.Popen(['sudo','bash', 'susi_installer/raspi/access_point/wap.sh'])
 
 os.system('sudo systemctl disable ss-susi-register.service')
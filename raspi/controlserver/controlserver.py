@@ -1,39 +1,583 @@
 import sys
 import os
+import json
 import subprocess
 import re
 import uuid
+import time
+import queue
+import threading
+import collections
+import hashlib
+import bisect
+import argparse
+import atexit
+import urllib.parse
 
 import logging
 import json_config
 import requests
+import requests.adapters
 import susi_config
+import playerd
+from urllib3.util.retry import Retry
 
 from flask import Flask , render_template , request, flash, redirect, session, abort, g, url_for
-from flask import jsonify
+from flask import jsonify, Response
 from werkzeug.security import generate_password_hash, check_password_hash
-
-from vlcplayer import vlcplayer
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
 app = Flask(__name__)
 logger = logging.getLogger(__name__)
 
+
+class Metrics():
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    # histograms are only recorded after enabling, otherwise observe()
+    # returns right away
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = collections.OrderedDict()
+
+    def histogram(self, name, helptext, labels):
+        self.histograms[name] = {'help': helptext, 'labels': labels, 'series': {}}
+
+    def observe(self, name, labelvalues, value):
+        if not self.enabled:
+            return
+        h = self.histograms[name]
+        with self.lock:
+            series = h['series'].get(labelvalues)
+            if series is None:
+                # counts per bucket (the last one is +Inf), sum
+                series = h['series'][labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, h in self.histograms.items():
+                lines.append("# HELP %s %s" % (name, h['help']))
+                lines.append("# TYPE %s histogram" % name)
+                for labelvalues, series in sorted(h['series'].items()):
+                    labels = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                      for k, v in zip(h['labels'], labelvalues))
+                    total = 0
+                    for le, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                        total += count
+                        lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, ',' if labels else '', le, total))
+                    lines.append('%s_sum{%s} %s' % (name, labels, repr(series[-1])))
+                    lines.append('%s_count{%s} %d' % (name, labels, total))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.histogram('susi_http_request_duration_seconds',
+                  'Duration of HTTP requests per Flask endpoint', ('endpoint', 'method', 'status'))
+metrics.histogram('susi_subprocess_duration_seconds',
+                  'Duration of spawned commands', ('command', 'returncode'))
+metrics.histogram('susi_api_request_duration_seconds',
+                  'Duration of requests to the SUSI.AI server', ('path', 'status'))
+metrics.histogram('susi_player_command_duration_seconds',
+                  'Duration of player commands', ('command',))
+
+def command_name(cmd):
+    # ['sudo', '-u', 'pi', '.../susi-config', 'set', ...] -> 'susi-config'
+    args = list(cmd)
+    while args and (args[0] in ('sudo', 'bash') or args[0].startswith('-')):
+        if args[0] == '-u':
+            args.pop(0)
+        args.pop(0)
+    return os.path.basename(args[0]) if args else ''
+
+def call_command(cmd, **kwargs):
+    start = time.monotonic()
+    ret = None
+    try:
+        ret = subprocess.call(cmd, **kwargs)  #nosec #pylint-disable type: ignore
+        return ret
+    finally:
+        metrics.observe('susi_subprocess_duration_seconds', (command_name(cmd), str(ret)),
+                        time.monotonic() - start)
+
+
+class PlayerRef():
+
+    # The player is either created in this process on first use, or, in
+    # the production serving mode, owned by a separate playerd process.
+    # Commands to a local player go through a PlayerActor like in playerd.
+    def __init__(self):
+        self.player = None
+        self.actor = None
+        self.remote = False
+        self.lock = threading.Lock()
+
+    def connect(self, socket_path):
+        self.player = playerd.PlayerClient(socket_path)
+        self.remote = True
+
+    def _player(self):
+        with self.lock:
+            if self.player is None:
+                from vlcplayer import vlcplayer as player
+                self.player = player
+                self.actor = playerd.PlayerActor(player)
+        return self.player
+
+    def _target(self):
+        # something with call/batch/stats methods
+        player = self._player()
+        return player if self.remote else self.actor
+
+    def batch(self, ops):
+        results = self._target().batch(ops)
+        for r in results:
+            if 'duration' in r:
+                metrics.observe('susi_player_command_duration_seconds', (r['cmd'],), r['duration'])
+        return results
+
+    def stats(self):
+        return self._target().stats()
+
+    def __getattr__(self, name):
+        if name not in playerd.commands:
+            return getattr(self._player(), name)
+        target = self._target()
+        def command(*args):
+            start = time.monotonic()
+            try:
+                return target.call(name, *args)
+            finally:
+                metrics.observe('susi_player_command_duration_seconds', (name,), time.monotonic() - start)
+        return command
+
+
+vlcplayer = PlayerRef()
+
+
+class EventHub():
+
+    # one listener on the player fans out to all connected /events clients
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.listening = False
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=100)
+        with self.lock:
+            if not self.listening:
+                vlcplayer.add_listener(self.publish)
+                self.listening = True
+            self.clients.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.clients.discard(q)
+
+    def publish(self, kind, data):
+        with self.lock:
+            clients = list(self.clients)
+        for q in clients:
+            try:
+                q.put_nowait((kind, data))
+            except queue.Full:
+                # slow client, it will miss this event
+                pass
+
+
+event_hub = EventHub()
+
+def sse_message(event, data):
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
 mountPath = '/media'
+audio_suffixes = ('.mp3', '.m4a', '.ogg', '.flac', '.wav')
+cache_path = susi_config.cache_path
 
 wifi_search_folder = os.path.join(dir_path, '../access_point')
 susiconfig = '/home/pi/SUSI.AI/bin/susi-config'
 cfg = susi_config.SusiConfig()
 
+# cfg follows changes of config.json by susi-config, the changes of these
+# keys are also sent to /events clients
+cfg.on_change(lambda k, old, new: event_hub.publish('config', {'key': k, 'value': new}),
+              ['roomname', 'language', 'device', 'wakebutton', 'stt', 'tts', 'susi.mode', 'hotword.engine'])
+
+def write_config(values):
+    cfg.update(values)
+
+def config_step(values):
+    # all values are written with one write of config.json if we may write it,
+    # otherwise a single susi-config call as user pi is used; a config.json
+    # that does not exist yet can be written if its directory can
+    path = cfg.conffile if os.path.exists(cfg.conffile) else os.path.dirname(cfg.conffile)
+    if os.access(path, os.W_OK):
+        return lambda: write_config(values)
+    return ['sudo', '-u', 'pi', susiconfig, 'set'] + [k + '=' + v for k, v in values]
+
+class SusiApi():
+
+    # tokens are renewed this many seconds before they expire
+    expiry_margin = 60
+
+    def __init__(self, base_url='https://api.susi.ai', tokenfile=None, timeout=(3.05, 10), retries=3):
+        self.base_url = base_url.rstrip('/')
+        self.tokenfile = tokenfile
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.token = None
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if self.tokenfile:
+            try:
+                with open(self.tokenfile, 'r') as f:
+                    self.token = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def _save_token(self):
+        if not self.tokenfile:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.tokenfile), exist_ok=True)
+            fd = os.open(self.tokenfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.token, f)
+        except OSError as e:
+            logger.warning("cannot save access token: %s", e)
+
+    def _get(self, path, params):
+        start = time.monotonic()
+        status = 'error'
+        try:
+            resp = self.session.get(self.base_url + '/' + path, params=params, timeout=self.timeout)
+            status = str(resp.status_code)
+            return resp
+        finally:
+            metrics.observe('susi_api_request_duration_seconds', (path, status), time.monotonic() - start)
+
+    def access_token(self, login, password):
+        # the token is bound to the credentials it was created with
+        ident = hashlib.sha256((login + '\0' + password).encode('utf-8')).hexdigest()
+        with self.lock:
+            now = time.time()
+            t = self.token
+            if t and t.get('ident') == ident and t.get('expires', 0) > now + self.expiry_margin:
+                return t['access_token']
+            data = self._get('aaa/login.json', {
+                'login': login,
+                'password': password,
+                'type': 'access-token'
+            }).json()
+            if 'access_token' not in data:
+                raise ValueError('login failed', data.get('message'))
+            self.token = {
+                'ident': ident,
+                'access_token': data['access_token'],
+                'expires': now + int(data.get('valid_seconds', 3600))
+            }
+            self._save_token()
+            return self.token['access_token']
+
+    def invalidate(self):
+        with self.lock:
+            self.token = None
+            if self.tokenfile and os.path.exists(self.tokenfile):
+                os.remove(self.tokenfile)
+
+    def call(self, path, params, login, password):
+        # a cached token might have been revoked, in this case log in again once
+        for attempt in range(2):
+            p = dict(params)
+            p['access_token'] = self.access_token(login, password)
+            resp = self._get(path, p)
+            if resp.status_code != 401 or attempt > 0:
+                break
+            self.invalidate()
+        return resp.json()
+
+
+api = SusiApi(os.environ.get('SUSI_API_URL', 'https://api.susi.ai'),
+              os.path.join(cache_path, 'token.json'))
+
 def get_token():
-    url = 'http://api.susi.ai/aaa/login.json'
-    PARAMS = {
-        'login': cfg.get('susi.user'),
-        'password': cfg.get('susi.pass'),
-        'type': 'access-token'
-    }
-    r1 = requests.get(url, params=PARAMS).json()
-    return r1['access_token']
+    return api.access_token(cfg.get('susi.user'), cfg.get('susi.pass'))
+
+class Job():
+
+    def __init__(self, name, steps):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # the command lines are kept private, they might contain passwords
+        self.commands = [cmd for _, cmd in steps]
+        self.steps = [{'name': n, 'state': 'pending', 'returncode': None, 'duration': None}
+                      for n, _ in steps]
+
+    def run(self):
+        self.state = 'running'
+        self.started = time.time()
+        failed = False
+        for step, cmd in zip(self.steps, self.commands):
+            step['state'] = 'running'
+            start = time.monotonic()
+            try:
+                if callable(cmd):
+                    # steps done in-process
+                    cmd()
+                    step['returncode'] = 0
+                else:
+                    step['returncode'] = call_command(cmd)
+            except Exception as e:
+                logger.error("job %s: step %s failed: %s", self.id, step['name'], e)
+                step['error'] = str(e)
+            step['duration'] = round(time.monotonic() - start, 3)
+            if step['returncode'] == 0:
+                step['state'] = 'done'
+            else:
+                step['state'] = 'failed'
+                failed = True
+        self.finished = time.time()
+        self.state = 'failed' if failed else 'done'
+
+    def as_dict(self):
+        done = len([s for s in self.steps if s['state'] in ('done', 'failed')])
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'progress': "%d/%d" % (done, len(self.steps)),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'steps': self.steps
+        }
+
+
+class JobQueue():
+
+    # number of finished jobs kept around for status queries
+    max_finished = 50
+
+    def __init__(self):
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._work, name='jobqueue', daemon=True)
+        self.worker.start()
+
+    def submit(self, name, steps):
+        job = Job(name, steps)
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.state in ('done', 'failed')]
+            for j in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.jobs[j.id]
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def all(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def _work(self):
+        # jobs are run one after the other, since most of them change
+        # the same configuration file or network setup
+        while True:
+            job = self.queue.get()
+            logger.info("job %s (%s) started", job.id, job.name)
+            job.run()
+            logger.info("job %s (%s) finished: %s", job.id, job.name, job.state)
+
+
+jobs = JobQueue()
+
+
+class AccessPointState():
+
+    # the hostapd state is probed by a background thread every `interval`
+    # seconds, but only while clients have asked for it within `idle` seconds
+    def __init__(self, interval=5, idle=60):
+        self.interval = interval
+        self.idle = idle
+        self.active = None
+        self.updated = 0
+        self.last_access = 0
+        self.changed = threading.Condition()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._work, name='apstate', daemon=True)
+        self.thread.start()
+
+    def probe(self):
+        try:
+            ret = call_command(['service', 'hostapd', 'status'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logger.error("cannot query hostapd state: %s", e)
+            return False
+        return ret == 0
+
+    def refresh(self):
+        active = self.probe()
+        with self.changed:
+            self.updated = time.monotonic()
+            if active != self.active:
+                logger.info("access point mode changed to %s", active)
+                self.active = active
+                self.changed.notify_all()
+        return active
+
+    def get(self):
+        self.last_access = time.monotonic()
+        if self.last_access - self.updated > 2 * self.interval:
+            # nobody asked for some time, the cached value is stale
+            self.refresh()
+            self.wakeup.set()
+        return self.active
+
+    def wait_change(self, active, timeout):
+        self.get()
+        with self.changed:
+            self.changed.wait_for(lambda: self.active != active, timeout)
+            return self.active
+
+    def _work(self):
+        while True:
+            if time.monotonic() - self.last_access > self.idle:
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.refresh()
+
+
+ap_state = AccessPointState()
+
+
+class MediaIndex():
+
+    # minimum number of seconds between two checks for changes on the drive
+    check_interval = 10
+
+    def __init__(self, root, cachefile):
+        self.root = root
+        self.cachefile = cachefile
+        self.lock = threading.Lock()
+        self.checked = None
+        # relative directory path -> { mtime, files, subdirs }
+        self.dirs = {}
+        self.songs = None
+        self.keys = None
+        try:
+            with open(self.cachefile, 'r') as f:
+                data = json.load(f)
+            if data.get('root') == self.root:
+                self.dirs = data['dirs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _scan(self):
+        # only directories whose mtime changed are listed again, all
+        # others are taken over from the previous index
+        new = {}
+        changed = False
+        todo = ['']
+        while todo:
+            rel = todo.pop()
+            path = os.path.join(self.root, rel)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entry = self.dirs.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                changed = True
+                entry = {'mtime': mtime, 'files': [], 'subdirs': []}
+                try:
+                    with os.scandir(path) as it:
+                        for e in it:
+                            if e.is_dir(follow_symlinks=False):
+                                entry['subdirs'].append(e.name)
+                            elif e.name.lower().endswith(audio_suffixes) and e.is_file():
+                                entry['files'].append(e.name)
+                except OSError as e:
+                    logger.warning("cannot scan %s: %s", path, e)
+                    continue
+            new[rel] = entry
+            todo.extend([os.path.join(rel, d) for d in entry['subdirs']])
+        if len(new) != len(self.dirs):
+            changed = True
+        return new, changed
+
+    def refresh(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.checked is not None and now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            dirs, changed = self._scan()
+            if not changed and self.songs is not None:
+                return
+            self.dirs = dirs
+            songs = [os.path.join(rel, f) for rel, entry in dirs.items() for f in entry['files']]
+            songs.sort(key=str.lower)
+            self.songs = songs
+            self.keys = [i.lower() for i in songs]
+            if changed:
+                try:
+                    os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+                    tmpfile = self.cachefile + '.tmp'
+                    with open(tmpfile, 'w') as f:
+                        json.dump({'root': self.root, 'dirs': dirs}, f)
+                    os.replace(tmpfile, self.cachefile)
+                except OSError as e:
+                    logger.warning("cannot save media index %s: %s", self.cachefile, e)
+
+    def query(self, offset=0, limit=None, q=None):
+        self.refresh()
+        songs = self.songs
+        if q:
+            q = q.lower()
+            songs = [s for s, k in zip(self.songs, self.keys) if q in k]
+        end = None if limit is None else offset + limit
+        return len(songs), songs[offset:end]
+
+
+media_indexes = {}
+media_indexes_lock = threading.Lock()
+
+def media_index(folder):
+    root = os.path.join(mountPath, folder)
+    if folder.startswith('.') or not os.path.isdir(root):
+        return None
+    with media_indexes_lock:
+        if folder not in media_indexes:
+            cachefile = os.path.join(cache_path, 'medialibrary', urllib.parse.quote(folder, safe='') + '.json')
+            media_indexes[folder] = MediaIndex(root, cachefile)
+        return media_indexes[folder]
+
+def detach_request():
+    # long-lived requests leave the worker pool of the serving mode,
+    # False if there are too many of them already
+    detach = request.environ.get('susi.detach')
+    return detach is None or detach()
 
 def do_return(msg, val):
     dm = {"status": msg}
@@ -41,28 +585,116 @@ def do_return(msg, val):
     resp.status_code = val
     return resp
 
+def do_job_return(job, display_message):
+    dm = dict(display_message)
+    dm['job'] = job.id
+    dm['job_url'] = url_for('job_status', job_id=job.id)
+    resp = jsonify(dm)
+    resp.status_code = 202
+    resp.headers['Location'] = dm['job_url']
+    return resp
+
+class PasswordStore():
+
+    # The password hash is read again only when the file changes. Whether
+    # access without password is possible is determined once per version
+    # of the file, since it is asked for on every request.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.version = None
+        self.hash = None
+        self.open_access = False
+
+    def _update(self, passhash, version):
+        self.hash = passhash
+        self.version = version
+        self.open_access = (passhash == 'default') or check_password_hash(passhash, '')
+
+    def _load(self):
+        st = os.stat(self.path)
+        version = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if version == self.version:
+            return
+        with open(self.path, "r") as f:
+            passhash = f.readline().splitlines()[0]
+        self._update(passhash, version)
+
+    def check(self, passw=''):
+        with self.lock:
+            self._load()
+            passhash = self.hash
+            if passw == '':
+                return self.open_access
+        return check_password_hash(passhash, passw)
+
+    def write(self, passw):
+        passhash = str(generate_password_hash(passw))
+        with self.lock:
+            with open(self.path, "w+") as fw:
+                fw.write(passhash)
+            st = os.stat(self.path)
+            self._update(passhash, (st.st_mtime_ns, st.st_size, st.st_ino))
+
+
+class LoginLimiter():
+
+    # at most `attempts` failed logins per client within `period` seconds
+    def __init__(self, attempts=5, period=60):
+        self.attempts = attempts
+        self.period = period
+        self.lock = threading.Lock()
+        self.failures = {}
+
+    def allow(self, client):
+        now = time.monotonic()
+        with self.lock:
+            failed = [t for t in self.failures.get(client, []) if now - t < self.period]
+            if failed:
+                self.failures[client] = failed
+            else:
+                self.failures.pop(client, None)
+            return len(failed) < self.attempts
+
+    def failed(self, client):
+        now = time.monotonic()
+        with self.lock:
+            # forget clients whose failures all expired, they might never
+            # come back and ask
+            for c in [c for c, failed in self.failures.items() if now - failed[-1] >= self.period]:
+                del self.failures[c]
+            self.failures.setdefault(client, []).append(now)
+
+
+passwords = PasswordStore(dir_path + '/pass.txt')
+login_limiter = LoginLimiter()
+
 def check_pass(passw=''):
-    f=open(dir_path+'/pass.txt', "r")
-    get_pass = f.readline().splitlines()[0]
-    if (passw=='' and get_pass=='default') or (check_password_hash(get_pass,passw)):
-        return True
-    else:
-        return False
+    return passwords.check(passw)
 
 def write_pass(passw):
-    fw=open(dir_path+"/pass.txt","w+")
-    fw.write(str(generate_password_hash(passw)))
+    passwords.write(passw)
     session['logged_in'] = False
 
 def access_mode():
-    stat = os.system('service hostapd status')
-    if not stat:
-        return True
-    return False
+    return ap_state.get()
 
 def return_mac():
     return ':'.join(re.findall('..', '%012x' % uuid.getnode()))
 
+@app.before_request
+def start_timer():
+    if metrics.enabled:
+        g.request_start = time.monotonic()
+
+@app.after_request
+def record_request(response):
+    if metrics.enabled and 'request_start' in g:
+        metrics.observe('susi_http_request_duration_seconds',
+                        (request.endpoint or '', request.method, str(response.status_code)),
+                        time.monotonic() - g.request_start)
+    return response
+
 @app.before_request
 def before_request_callback():
     #if (request.endpoint == 'setup' or request.endpoint == 'auth'\
@@ -83,13 +715,24 @@ def control():
 
 @app.route('/setup')
 def setup():
-    access_mode()
     return render_template('setup.html')
 
 #End-point to check whether the device is in access point mode
+# /check_ap?wait=NN&status=true|false waits up to NN seconds (at most 60)
+# for the state to differ from the given status before answering
 @app.route('/check_ap')
 def check_ap_mode():
-    if access_mode():
+    if 'wait' in request.args and 'status' in request.args:
+        try:
+            timeout = min(60, max(0, float(request.args.get('wait'))))
+        except ValueError:
+            return do_return('Invalid wait argument', 400)
+        if not detach_request():
+            return do_return('Too many waiting requests', 503)
+        active = ap_state.wait_change(request.args.get('status') == 'true', timeout)
+    else:
+        active = access_mode()
+    if active:
         dm = {"status": "true"}
     else:
         dm = {"status": "false"}
@@ -98,9 +741,12 @@ def check_ap_mode():
 
 @app.route('/login', methods=['POST', 'PUT'])
 def setlogin():
+    if not login_limiter.allow(request.remote_addr):
+        return do_return('Too many failed logins, try again later', 429)
     if check_pass(request.form['password']):
         session['logged_in'] = True
     else:
+        login_limiter.failed(request.remote_addr)
         flash('wrong password!')
     return redirect(url_for('control'))
 
@@ -111,6 +757,13 @@ def set_password():
         return redirect(url_for('control'))
     return render_template('password.html')
 
+# Prometheus text format, only available with --metrics
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    if not metrics.enabled:
+        return do_return('Metrics are not enabled', 404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/status', methods=['POST', 'PUT'])
 def status_route():
     return do_return('Ok', 200)
@@ -125,16 +778,70 @@ def mac_id():
 @app.route('/unlink_device', methods=['GET', 'POST'])
 def unlink_device():
     mac = return_mac()
-    access_token = get_token()
-    PARAMS = {
-        'macid': mac,
-        'access_token': access_token
-    }
-    url = 'https://api.susi.ai/aaa/removeUserDevices.json'
-    result = requests.get(url, params=PARAMS).json()
+    try:
+        result = api.call('aaa/removeUserDevices.json', {'macid': mac},
+                          cfg.get('susi.user'), cfg.get('susi.pass'))
+    except (requests.RequestException, ValueError) as e:
+        logger.error("unlinking device failed: %s", e)
+        return do_return('SUSI.AI server not reachable', 502)
     resp = jsonify(result)
     return resp
 
+@app.route('/jobs', methods=['GET'])
+def job_list():
+    return jsonify([j.as_dict() for j in jobs.all()])
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return do_return('Unknown job', 404)
+    return jsonify(job.as_dict())
+
+# Server-Sent Events stream of player changes, starting with a
+# status event with the current state
+@app.route('/events', methods=['GET'])
+def events():
+    if not detach_request():
+        return do_return('Too many event streams', 503)
+    q = event_hub.subscribe()
+    def stream():
+        try:
+            yield sse_message('status', vlcplayer.status())
+            while True:
+                try:
+                    kind, data = q.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_message(kind, data)
+        finally:
+            event_hub.unsubscribe(q)
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# /batch with a JSON list of operations, e.g.
+#   [ { "cmd": "save_softvolume" }, { "cmd": "say", "args": [ "file:///tmp/answer.wav" ] },
+#     { "cmd": "restore_softvolume" } ]
+# executes them in order without other player commands in between
+@app.route('/batch', methods=['POST', 'PUT'])
+def batch_route():
+    ops = request.get_json(silent=True)
+    try:
+        playerd.check_batch(ops)
+    except ValueError as e:
+        return do_return('Invalid batch: ' + str(e), 400)
+    start = time.monotonic()
+    results = vlcplayer.batch(ops)
+    failed = any('error' in r for r in results)
+    resp = jsonify({
+        "status": 'Error' if failed else 'Ok',
+        "results": results,
+        "duration": round(time.monotonic() - start, 4)
+    })
+    resp.status_code = 500 if failed else 200
+    return resp
+
 # /play?ytb=???
 # /play?mrl=???
 @app.route('/play', methods=['POST', 'PUT'])
@@ -148,6 +855,20 @@ def play_route():
     else:
         return do_return('Unknown play mode', 400)
 
+# /prefetch?ytb=???
+# /prefetch?link=???
+# resolves a YouTube stream in the background so that playing it later starts faster
+@app.route('/prefetch', methods=['POST', 'PUT'])
+def prefetch_route():
+    if 'ytb' in request.args:
+        vlcplayer.prefetchytb(request.args.get('ytb'))
+        return do_return('Ok', 200)
+    elif 'link' in request.args:
+        vlcplayer.prefetchytbLink(request.args.get('link'))
+        return do_return('Ok', 200)
+    else:
+        return do_return('Unknown prefetch mode', 400)
+
 # /volume?val=up
 # /volume?val=down
 # /volume?val=NN  0 <= NN <= 100
@@ -212,10 +933,24 @@ def restart_route():
     vlcplayer.restart()
     return do_return('Ok', 200)
 
+# /shuffle toggles shuffle mode
+# /shuffle?mode=on|off
 @app.route('/shuffle', methods=['POST', 'PUT'])
 def shuffle_route():
-    vlcplayer.shuffle()
-    return do_return('Ok', 200)
+    mode = request.args.get('mode')
+    if mode not in (None, 'on', 'off'):
+        return do_return('Invalid shuffle mode', 400)
+    shuffled = vlcplayer.shuffle(mode)
+    resp = jsonify({"status": 'Ok', "shuffle": shuffled})
+    return resp
+
+# /player_stats returns the depth of the player command queue, the
+# latency of the player commands and the time to first audio per source
+@app.route('/player_stats', methods=['GET'])
+def player_stats_route():
+    stats = vlcplayer.stats()
+    stats['play'] = vlcplayer.play_stats()
+    return jsonify(stats)
 
 @app.route('/save_softvolume', methods=['POST', 'PUT'])
 def save_softvolume_route():
@@ -260,19 +995,41 @@ def restore_hardvolume_route():
 def get_mounted_device():
     folders = os.listdir(mountPath)
     devices = [{'name': d} for d in folders]
+    # build the index of new devices in the background
+    for d in folders:
+        index = media_index(d)
+        if index is not None and index.songs is None:
+            threading.Thread(target=index.refresh, daemon=True).start()
 
     return do_return(devices, 200)
 
+# /getOfflineSong/<folder>?offset=NN&limit=NN&q=???
+# songs are sorted by their path relative to the device, q filters
+# case insensitive on that path
 @app.route('/getOfflineSong/<folder>', methods=['GET'])
 def get_offline_song(folder):
-    files = os.listdir(os.path.join(mountPath,folder))
-    songs = [{'name': i} for i in files if i.endswith('.mp3') or i.endswith('.m4a') or i.endswith('.ogg') ]
-    return do_return(songs, 200)
+    index = media_index(folder)
+    if index is None:
+        return do_return('Unknown device', 404)
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = request.args.get('limit')
+        if limit is not None:
+            limit = max(0, int(limit))
+    except ValueError:
+        return do_return('Invalid offset or limit', 400)
+    total, songs = index.query(offset, limit, request.args.get('q'))
+    resp = jsonify({"status": [{'name': i} for i in songs], "total": total, "offset": offset})
+    return resp
 
-@app.route('/playOfflineSong/<folder>/<file>', methods=['PUT'])
+@app.route('/playOfflineSong/<folder>/<path:file>', methods=['PUT'])
 def play_offine_song(folder, file):
+    root = os.path.realpath(os.path.join(mountPath, folder))
+    song = os.path.realpath(os.path.join(root, file))
+    if os.path.commonpath([root, song]) != root:
+        return do_return('Invalid song', 400)
     vlcplayer.stop()
-    vlcplayer.play(os.path.join(mountPath, folder, file))
+    vlcplayer.play(song)
     return do_return('OK', 200)
 
 @app.route('/playyoutube', methods=['PATCH'])
@@ -309,42 +1066,38 @@ def login():
         auth = 'authenticated'
     email = request.args.get('email')
     password = request.args.get('password')
-    subprocess.call(['sudo', '-u', 'pi', susiconfig, 'set', "susi.mode="+auth, "susi.user="+email, "susi.pass="+password]) #nosec #pylint-disable type: ignore
-    display_message = {"authentication":"successful", "auth": auth, "email": email, "password": password}
+    steps = [('susi-config', config_step([('susi.mode', auth), ('susi.user', email), ('susi.pass', password)]))]
     if auth == 'authenticated' and email != "":
-        os.system('sudo systemctl enable ss-susi-register.service')
-    resp = jsonify(display_message)
-    resp.status_code = 200
-    return resp # pylint-enable
+        steps.append(('register', ['sudo', 'systemctl', 'enable', 'ss-susi-register.service']))
+    job = jobs.submit('auth', steps)
+    display_message = {"authentication":"successful", "auth": auth, "email": email, "password": password}
+    return do_job_return(job, display_message)
 
 @app.route('/wifi_credentials', methods=['GET'])
 def wifi_config():
     wifi_ssid = request.args.get('wifissid')
     wifi_password = request.args.get('wifipassd')
-    subprocess.call(['sudo', 'bash', wifi_search_folder + '/wifi_search.sh', wifi_ssid, wifi_password])  #nosec #pylint-disable type: ignore
+    job = jobs.submit('wifi_credentials',
+        [('wifi_search', ['sudo', 'bash', wifi_search_folder + '/wifi_search.sh', wifi_ssid, wifi_password])])
     display_message = {"wifi":"configured", "wifi_ssid":wifi_ssid, "wifi_password": wifi_password}
-    resp = jsonify(display_message)
-    resp.status_code = 200
-    return resp  # pylint-enable
+    return do_job_return(job, display_message)
 
 @app.route('/add_wifi', methods=['GET'])
 def add_wifi():
     wifi_ssid = request.args.get('wifissid')
     wifi_password = request.args.get('wifipassd')
-    subprocess.call(['sudo', 'bash', wifi_search_folder + '/add_wifi.sh', wifi_ssid, wifi_password])  #nosec #pylint-disable type: ignore
+    job = jobs.submit('add_wifi',
+        [('add_wifi', ['sudo', 'bash', wifi_search_folder + '/add_wifi.sh', wifi_ssid, wifi_password])])
     display_message = {"wifi":"configured", "wifi_ssid":wifi_ssid, "wifi_password": wifi_password}
-    resp = jsonify(display_message)
-    resp.status_code = 200
-    return resp  # pylint-enable
+    return do_job_return(job, display_message)
 
 @app.route('/speaker_config', methods=['GET'])
 def speaker_config():
     room_name = request.args.get('room_name')
-    subprocess.call(['sudo', '-u', 'pi', susiconfig, 'set', 'roomname="'+room_name+'"']) #nosec #pylint-disable type: ignore
+    job = jobs.submit('speaker_config',
+        [('susi-config', config_step([('roomname', room_name)]))])
     display_message = {"room_name":room_name}
-    resp = jsonify(display_message)
-    resp.status_code = 200
-    return resp
+    return do_job_return(job, display_message)
 
 # the reboot service combines all other services in one call
 # the current version allows anonymous operation mode
@@ -354,12 +1107,12 @@ def speaker_config():
 def reboot():
     # speaker_config
     room_name = request.form['room_name']
-    subprocess.call(['sudo', '-u', 'pi', susiconfig, 'set', 'roomname="'+room_name+'"']) #nosec #pylint-disable type: ignore
+    values = [('roomname', room_name)]
 
     # wifi_credentials
     wifi_ssid = request.form['wifissid']
     wifi_password = request.form['wifipassd']
-    subprocess.call(['sudo', 'bash', wifi_search_folder + '/wifi_search.sh', wifi_ssid, wifi_password])  #nosec #pylint-disable type: ignore
+    steps = [('wifi_credentials', ['sudo', 'bash', wifi_search_folder + '/wifi_search.sh', wifi_ssid, wifi_password])]
 
     # auth
     auth = request.form['auth']
@@ -370,20 +1123,19 @@ def reboot():
     email = request.form['email']
     password = request.form['password']
 
-    subprocess.call(['sudo', '-u', 'pi', susiconfig, 'set', "susi.mode="+auth, "susi.user="+email, "susi.pass="+password])
+    values.extend([('susi.mode', auth), ('susi.user', email), ('susi.pass', password)])
     if auth == 'authenticated' and email != "":
-        os.system('sudo systemctl enable ss-susi-register.service')
+        steps.append(('register', ['sudo', 'systemctl', 'enable', 'ss-susi-register.service']))
 
     # config
-    susiconfigcall = ['sudo', '-u', 'pi', susiconfig, 'set' ]
     display_message = {}
     if 'stt' in request.form:
-        susiconfigcall.append('stt=' + request.form['stt'])
+        values.append(('stt', request.form['stt']))
         display_message['stt'] = request.form['stt']
     else:
         display_message['stt'] = cfg.get('stt')
     if 'tts' in request.form:
-        susiconfigcall.append('tts=' + request.form['tts'])
+        values.append(('tts', request.form['tts']))
         display_message['tts'] = request.form['tts']
         display_message['tts'] = cfg.get('tts')
     hotword = request.form['hotword']
@@ -398,14 +1150,97 @@ def reboot():
     display_message['auth'] = auth
     display_message['email'] = email
     display_message['message'] = "SUSI is rebooting"
-    susiconfigcall.append('hotword.engine=' + hotword)
-    subprocess.Popen(susiconfigcall)  #nosec #pylint-disable type: ignore
-    resp = jsonify(display_message)
-    resp.status_code = 200
-    subprocess.Popen(['sudo','rfkill','unblock','wifi'])
-    subprocess.Popen(['sudo','bash', os.path.join(wifi_search_folder,'rwap.sh')])
-    return resp  # pylint-enable
+    values.append(('hotword.engine', hotword))
+    # the whole form is written to config.json at once
+    steps.insert(0, ('config', config_step(values)))
+    steps.append(('rfkill', ['sudo','rfkill','unblock','wifi']))
+    steps.append(('rwap', ['sudo','bash', os.path.join(wifi_search_folder,'rwap.sh')]))
+    job = jobs.submit('reboot', steps)
+    return do_job_return(job, display_message)
+
+class DetachingRequestHandler(WSGIRequestHandler):
+
+    def make_environ(self):
+        environ = super().make_environ()
+        environ['susi.detach'] = self.server.local.detach
+        return environ
+
+
+class PoolWSGIServer(BaseWSGIServer):
+
+    # At most `workers` requests are processed at a time. Long-lived requests
+    # (/events, waiting /check_ap) leave this pool via environ['susi.detach']
+    # and count against max_streams instead, so that they cannot block the
+    # other requests.
+    multithread = True
+    max_streams = 16
+
+    def __init__(self, host, port, app, workers):
+        super().__init__(host, port, app, handler=DetachingRequestHandler)
+        self.slots = threading.BoundedSemaphore(workers)
+        self.streams = threading.BoundedSemaphore(self.max_streams)
+        self.local = threading.local()
+
+    def process_request(self, request, client_address):
+        threading.Thread(target=self._process_request, args=(request, client_address),
+                         name='http', daemon=True).start()
+
+    def _process_request(self, request, client_address):
+        self.slots.acquire()
+        held = [self.slots]
+        def detach():
+            # returns False if there are too many long-lived requests already
+            if held[0] is self.streams:
+                return True
+            if not self.streams.acquire(blocking=False):
+                return False
+            held[0] = self.streams
+            self.slots.release()
+            return True
+        self.local.detach = detach
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            held[0].release()
+
+
+def start_playerd(socket_path, timeout=10):
+    proc = subprocess.Popen([sys.executable, '-m', 'playerd', socket_path])
+    atexit.register(proc.terminate)
+    deadline = time.monotonic() + timeout
+    while not playerd.is_running(socket_path):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            raise Exception('player daemon did not start')
+        time.sleep(0.1)
+    return proc
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SUSI.AI control server')
+    parser.add_argument('--port', type=int, default=7070)
+    parser.add_argument('--workers', type=int, default=0,
+        help='serve requests with a pool of this many threads and run the player in a separate process')
+    parser.add_argument('--player-socket',
+        help='Unix socket of the player daemon, started by the control server if not running')
+    parser.add_argument('--metrics', action='store_true',
+        help='record latencies and provide them at /metrics')
+    args = parser.parse_args()
+    metrics.enabled = args.metrics
+
     app.secret_key = os.urandom(12)
-    app.run(debug=False, port=7070, host='0.0.0.0')
+    if args.workers > 0:
+        if not args.player_socket:
+            args.player_socket = os.path.join(os.environ.get('XDG_RUNTIME_DIR', cache_path), 'susi-playerd.sock')
+        if not playerd.is_running(args.player_socket):
+            os.makedirs(os.path.dirname(args.player_socket), exist_ok=True)
+            start_playerd(args.player_socket)
+        vlcplayer.connect(args.player_socket)
+        logger.info("serving on port %d with %d workers", args.port, args.workers)
+        PoolWSGIServer('0.0.0.0', args.port, app, args.workers).serve_forever()
+    else:
+        if args.player_socket:
+            vlcplayer.connect(args.player_socket)
+        app.run(debug=False, port=args.port, host='0.0.0.0')